@@ -29,6 +29,12 @@ class AutopatchModule(Module):
         self.patchAttempts = []
         self._cammod = None
         self._camdev = None
+        self._taskRunners = {}
+        # last exposure/trigger channel pair applied to the camera (see
+        # TaskRunnerPatchProtocol.configureCamera)
+        self.lastCameraChannels = None
+        # last commanded filter turret position (see TaskRunnerPatchProtocol._setTurret)
+        self.lastTurretPos = None
         self._nextPointID = 0
         self._plateCenter = config.get("plateCenter", (0, 0, 0))
 
@@ -140,6 +146,23 @@ class AutopatchModule(Module):
             self._camdev = manager.getDevice(camName)
         return self._camdev
 
+    def getTaskRunner(self, clampName):
+        """Return the Task Runner module that has a dock for the named clamp device.
+
+        The clamp => task runner mapping is static for the session, so the result of
+        the module scan is cached.
+        """
+        if clampName not in self._taskRunners:
+            manager = getManager()
+            for modName in manager.listModules():
+                if not modName.startswith("Task Runner"):
+                    continue
+                mod = manager.getModule(modName)
+                if clampName in mod.docks:
+                    self._taskRunners[clampName] = mod
+                    break
+        return self._taskRunners.get(clampName)
+
     def protocolComboChanged(self):
         prot = str(self.ui.protocolCombo.currentText())
         self.jobQueue.setProtocol(allPatchProtocols()[prot])
@@ -22,9 +22,13 @@ class PatchThread(Thread):
         self.jobQueue = module.jobQueue
         self.module = module
         self._stop = False
+        self._protocol = None
 
     def stop(self):
         self._stop = True
+        protocol = self._protocol
+        if protocol is not None:
+            protocol.stopRequested()
 
     def start(self):
         self._stop = False
@@ -53,6 +57,7 @@ class PatchThread(Thread):
                 pa.startLogging()
                 pa.setStatus(f"start patch protocol: {pa.protocol.name}")
                 protocol = pa.protocol(self, pa)
+                self._protocol = protocol
                 protocol.runPatchProtocol()
                 if pa.error is None:
                     pa.setStatus("success")
@@ -65,4 +70,5 @@ class PatchThread(Thread):
             except Exception as exc:
                 pa.setError(sys.exc_info())
             finally:
+                self._protocol = None
                 pa.stopLogging()
@@ -41,6 +41,14 @@ class PatchProtocol(object):
         """
         self.patchThread.checkStop()
 
+    def stopRequested(self):
+        """Called (from another thread) when a stop has been requested for the thread
+        running this protocol.
+
+        May be reimplemented to wake up any blocking waits so that checkStop() can run.
+        """
+        pass
+
     def lock(self, lock, timeout=20.0):
         """Return a context manager that attempts to lock a mutex while checking for abort requests.
         """
@@ -8,6 +8,12 @@ from acq4.util.threadrun import runInGuiThread
 
 from .patch_protocol import PatchProtocol
 
+# How far above target to run calibration?
+#  - low values (10 um) potentially have worse machine vision performance due to being very close to cells
+#  - high values (100 um) potentially yield a bad correction due to errors that accumulate over the large distance to the cell
+_CALIBRATION_HEIGHT = 30e-6
+_CALIBRATION_OFFSET = np.array([0.0, 0.0, _CALIBRATION_HEIGHT])
+
 
 class RecalibrateProtocol(PatchProtocol):
     """Base class for protocols that visit each target +10um and measure the pipette calibration error 
@@ -23,44 +29,50 @@ class RecalibrateProtocol(PatchProtocol):
         self.stageCameraLock = self.module.stageCameraLock
         self.camera = self.module.getCameraDevice()
         self.cameraMod = self.module.getCameraModule()
+        self._targetPos = None
 
     def runPatchProtocol(self):
-        # How far above target to run calibration?
-        #  - low values (10 um) potentially have worse machine vision performance due to being very close to cells
-        #  - high values (100 um) potentially yield a bad correction due to errors that accumulate over the large distance to the cell
-        calibrationHeight = 30e-6
-
         pa = self.patchAttempt
         if not hasattr(pa, "originalPosition"):
             pa.originalPosition = np.array(pa.position)
 
-        # move to 100 um above current position
-        pos = self.dev.pipetteDevice.globalPosition()
-        pos[2] += 100e-6
-        fut = self.dev.pipetteDevice._moveToGlobal(pos, "fast")
-        self.wait([fut])
-
-        # move to 100 um above target z value
-        pos = pa.pipetteTargetPosition()
-        pos[2] += 100e-6
-        fut = self.dev.pipetteDevice._moveToGlobal(pos, "fast")
-        self.wait([fut])
-
-        # set pipette target position
-        self.dev.pipetteDevice.setTarget(pa.pipetteTargetPosition())
+        # resolve the corrected target once for the whole run; repeated calls
+        # recompute (and reallocate) it, and a concurrent error update mid-run
+        # would make the calibration math internally inconsistent
+        target = np.asarray(pa.pipetteTargetPosition())
+        self._targetPos = target
+
+        # request the stage/camera lock now; it is granted in the background while
+        # the pipette is still moving, so none of the hops below wait for it
+        with self.stageCameraLock.acquire() as lockFut:
+            # move to 100 um above current position, unless we are already above
+            # the safe height for this target
+            pos = self.dev.pipetteDevice.globalPosition()
+            if pos[2] < target[2] + 100e-6:
+                pos[2] += 100e-6
+                fut = self.dev.pipetteDevice._moveToGlobal(pos, "fast")
+                self.wait([fut])
+
+            # move to 100 um above target z value
+            pos = target.copy()
+            pos[2] += 100e-6
+            fut = self.dev.pipetteDevice._moveToGlobal(pos, "fast")
+            self.wait([fut])
+
+            # set pipette target position
+            self.dev.pipetteDevice.setTarget(target)
+
+            # move pipette to just above corrected target
+            pipPos = target + _CALIBRATION_OFFSET
+            # don't use target move here; we don't need all the obstacle avoidance.
+            # fut = self.dev.pipetteDevice.goTarget(speed='fast')
+            pfut = self.dev.pipetteDevice._moveToGlobal(pipPos, speed="slow")
 
-        # move pipette to 10 um above corrected target
-        pipPos = pa.pipetteTargetPosition() + np.array([0, 0, calibrationHeight])
-        # don't use target move here; we don't need all the obstacle avoidance.
-        # fut = self.dev.pipetteDevice.goTarget(speed='fast')
-        pfut = self.dev.pipetteDevice._moveToGlobal(pipPos, speed="slow")
-
-        with self.stageCameraLock.acquire() as fut:
             pa.setStatus("Waiting for stage/camera")
-            self.wait([fut], timeout=None)
+            self.wait([lockFut], timeout=None)
 
             # move stage/focus above actual target
-            camPos = pa.globalTargetPosition() + np.array([0, 0, calibrationHeight])
+            camPos = pa.globalTargetPosition() + _CALIBRATION_OFFSET
             cfut = self.camera.moveCenterToGlobal(camPos, "fast")
             self.wait([pfut, cfut], timeout=None)
 
@@ -97,29 +109,36 @@ class AutoRecalibrateProtocol(RecalibrateProtocol):
         targetErrVals = []
         focusErrVals = []
 
-        targetPos = np.array(pa.pipetteTargetPosition())
+        targetPos = self._targetPos
+        if targetPos is None:
+            targetPos = np.asarray(pa.pipetteTargetPosition())
+
+        camera = self.camera
+        pipette = self.dev.pipetteDevice
+        tracker = pipette.tracker
 
         # Make a few attempts to optimize pipette position. Iterate until
         #  - z is in focus on the pipette tip
         #  - pipette x,y is over the target
         for i in range(4):
-            cameraPos = self.camera.globalCenterPosition("roi")
+            cameraPos = camera.globalCenterPosition("roi")
 
             # pipette position according to manipulator
-            reportedPos = np.array(self.dev.pipetteDevice.globalPosition())
+            reportedPos = np.array(pipette.globalPosition())
 
             # estimate tip position measured by machine vision
-            measuredPos, perf = self.dev.pipetteDevice.tracker.measureTipPosition(threshold=0.4, movePipette=False)
+            measuredPos, perf = tracker.measureTipPosition(threshold=0.4, movePipette=False)
             measuredPos = np.array(measuredPos)
 
             # generate some error metrics:
             # how far is the pipette from its reported position
             pipetteDiff = measuredPos - reportedPos
             # how far in Z is the pipette from the focal plane
-            focusError = abs(measuredPos[2] - cameraPos[2])
+            focusError = float(abs(measuredPos[2] - cameraPos[2]))
             # how far in XY is the pipette from the target
+            # (hypot avoids the array temporaries linalg.norm creates for a 2-vector)
             targetDiff = targetPos[:2] - measuredPos[:2]
-            targetError = np.linalg.norm(targetDiff)
+            targetError = float(np.hypot(targetDiff[0], targetDiff[1]))
 
             # track performance so we can decide later whether to abandon this point
             perfVals.append(perf)
@@ -127,20 +146,24 @@ class AutoRecalibrateProtocol(RecalibrateProtocol):
             focusErrVals.append(focusError)
             targetErrVals.append(targetError)
 
-            # show the error line and pause briefly (just for debugging; we could remove this to speed up the process)
-            self.showErrorLine(reportedPos, measuredPos)
+            needFocus = focusError > 3e-6
+            needMove = targetError > 1.5e-6
+
+            if needFocus or needMove:
+                # show the error line while we adjust (just for debugging; skipped once in tolerance)
+                self.showErrorLine(reportedPos, measuredPos)
 
             futs = []
-            if focusError > 3e-6:
+            if needFocus:
                 # refocus on pipette tip (don't move pipette in z because if error prediction is wrong, we could crash)
                 cameraPos[2] = measuredPos[2]
-                futs.append(self.camera.moveCenterToGlobal(cameraPos, "slow"))
+                futs.append(camera.moveCenterToGlobal(cameraPos, "slow"))
 
-            if targetError > 1.5e-6:
-                # reposition pipette x,y closer to target
-                ppos = reportedPos.copy()
-                ppos[:2] += targetDiff
-                futs.append(self.dev.pipetteDevice._moveToGlobal(ppos, "slow"))
+            if needMove:
+                # reposition pipette x,y closer to target; reportedPos is freshly
+                # allocated each iteration, so adjust it in place rather than copying
+                reportedPos[:2] += targetDiff
+                futs.append(pipette._moveToGlobal(reportedPos, "slow"))
 
             if len(futs) > 0:
                 # wait for requested moves to complete and try again
@@ -161,15 +184,16 @@ class AutoRecalibrateProtocol(RecalibrateProtocol):
         return pipetteDiff
 
     def showErrorLine(self, pt1, pt2):
+        # draw the line and schedule its removal in the GUI thread; this is debug
+        # visualization only, so don't block the calibration loop while it shows
         runInGuiThread(self._showErrorLine, pt1, pt2)
-        time.sleep(1.5)
-        runInGuiThread(self._removeErrorLine)
 
     def _showErrorLine(self, pt1, pt2):
         self._removeErrorLine()
         self.line = Qt.QGraphicsLineItem(pt1[0], pt1[1], pt2[0], pt2[1])
         self.line.setPen(pg.mkPen("r"))
         self.cameraMod.window().addItem(self.line)
+        Qt.QTimer.singleShot(1500, self._removeErrorLine)
 
     def _removeErrorLine(self):
         if self.line is None:
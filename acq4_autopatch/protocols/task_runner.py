@@ -1,17 +1,32 @@
+import math
 import sys
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
+import pyqtgraph as pg
 
-try:
-    import queue
-except ImportError:
-    import Queue as queue
 from acq4.Manager import getManager
-from acq4.util import Qt
+from acq4.util import Qt, ptime
 from acq4.util.threadrun import runInGuiThread
 from .patch_protocol import PatchProtocol
 
+# sentinel placed in the state queue to wake up a blocking get() when a stop is requested
+_STOP_SENTINEL = object()
+
+# number of pipette state transitions buffered for the patch loop; if the consumer
+# falls behind, the oldest (stale) transitions are dropped
+_STATE_QUEUE_DEPTH = 8
+
+# shared pool for writing images to disk in the background (see _saveImage)
+_imageWriterPool = ThreadPoolExecutor(max_workers=2)
+
+# staged-approach offsets from the target position (see _approachTarget)
+_FAST_APPROACH_OFFSET = np.array([100e-6, 100e-6, 100e-6])
+_SLOW_APPROACH_OFFSET = np.array([0.0, 0.0, 10e-6])
+
 
 class TaskRunnerPatchProtocol(PatchProtocol):
     """Patch protocol implementing:
@@ -33,16 +48,114 @@ class TaskRunnerPatchProtocol(PatchProtocol):
         self.scope = self.camera.getScopeDevice()
 
         man = getManager()
+        self._man = man
+        self._turret = None
+        self._illum = None
         self.dh = man.getCurrentDir().mkdir(f"patch_attempt_{self.patchAttempt.pid:04d}", autoIncrement=True)
         patchAttempt.setLogFile(self.dh["patch.log"])
 
-        self.stateQueue = queue.Queue()
-        # this code is running in a thread, so it is necessary to specify that
-        # the signal must be delivered in the main thread (since we are not running an event loop)
+        self._pendingSaves = []
+
+        # if the scope reports illumination changes, we can wait on an event after
+        # moving the filter turret instead of sleeping a fixed time
+        self._scopeChanged = None
+        if hasattr(self.scope, "sigLightChanged"):
+            self._scopeChanged = threading.Event()
+            self.scope.sigLightChanged.connect(self._scopeLightChanged, Qt.Qt.DirectConnection)
+
+        # likewise, wait on the camera's restart notification rather than a fixed sleep
+        self._cameraStarted = None
+        if hasattr(self.camera, "sigCameraStarted"):
+            self._cameraStarted = threading.Event()
+            self.camera.sigCameraStarted.connect(self._cameraStartedEvent, Qt.Qt.DirectConnection)
+
+        # bounded drop-oldest buffer of state transitions; only the most recent
+        # transitions matter, so the consumer never walks a long stale backlog
+        self._stateQueueCond = threading.Condition()
+        self.stateQueue = deque(maxlen=_STATE_QUEUE_DEPTH)
+        self._droppedStates = 0
+        self._currentState = None
+        # DirectConnection is required here: this protocol runs in a worker thread with
+        # no Qt event loop, so a queued connection would never be delivered. The slot is
+        # invoked synchronously in the emitting thread, but it only does a thread-safe
+        # queue put, so the emitter is not blocked in any meaningful way.
         self.dev.stateManager().sigStateChanged.connect(self.devStateChanged, Qt.Qt.DirectConnection)
 
+    def _getTurretAndIllum(self):
+        """Return the (cached) filter turret and illumination devices.
+
+        These are looked up lazily so that subclasses overriding the illumination
+        hooks never require the devices to exist.
+        """
+        if self._turret is None:
+            self._turret = self._man.getDevice("FilterTurret")
+            self._illum = self._man.getDevice("Illumination")
+        return self._turret, self._illum
+
+    def _setTurret(self, pos):
+        """Move the filter turret to *pos*, skipping the round-trip when it is already
+        at the last commanded position.
+
+        After a real move, wait for the scope's automatic RL/TL adjustment so callers
+        can safely override the illumination settings.
+
+        The last commanded position is tracked on the module (protocol instances are
+        per-attempt, and the turret is only touched under stageCameraLock), so the
+        restore to brightfield at the end of one attempt lets the next attempt skip
+        its initial brightfield switch.
+        """
+        if self.module.lastTurretPos == pos:
+            return
+        turret, _ = self._getTurretAndIllum()
+        if self._scopeChanged is not None:
+            self._scopeChanged.clear()
+        turret.setPosition(pos).wait()
+        self.module.lastTurretPos = pos
+        self._waitForScopeChange(2.0)
+
+    def _scopeLightChanged(self, *args):
+        self._scopeChanged.set()
+
+    def _cameraStartedEvent(self, *args):
+        self._cameraStarted.set()
+
+    def _waitForScopeChange(self, timeout):
+        """Wait up to *timeout* seconds for the scope to report an illumination change.
+
+        The scope automatically changes RL/TL settings when the filter turret moves,
+        sometimes in a bad way; callers wait for that to happen, then set them manually.
+        Falls back to sleeping the full *timeout* if the scope has no change signal.
+        """
+        if self._scopeChanged is None:
+            time.sleep(timeout)
+        else:
+            self._scopeChanged.wait(timeout)
+
     def devStateChanged(self, stateManager, state):
-        self.stateQueue.put(state)
+        self._putState(state)
+
+    def _putState(self, state):
+        with self._stateQueueCond:
+            if len(self.stateQueue) == self.stateQueue.maxlen:
+                self._droppedStates += 1
+            self.stateQueue.append(state)
+            self._stateQueueCond.notify()
+
+    def _getNextState(self):
+        """Block until a state transition (or stop sentinel) arrives and return it.
+        """
+        with self._stateQueueCond:
+            while len(self.stateQueue) == 0:
+                self._stateQueueCond.wait()
+            return self.stateQueue.popleft()
+
+    def stopRequested(self):
+        # wake up patchCell: the sentinel unblocks the queue read, and stopping the
+        # current pipette state unblocks any pending state.wait()
+        self._putState(_STOP_SENTINEL)
+        state = self._currentState
+        if state is not None:
+            state.stop()
 
     def runPatchProtocol(self):
         pa = self.patchAttempt
@@ -51,10 +164,12 @@ class TaskRunnerPatchProtocol(PatchProtocol):
             self.cleanPipette()
 
         try:
+            # start the approach right away; the bath state settles while the
+            # pipette moves (patchCell enforces the remainder of the settle time)
             self.dev.setState("bath")
-            time.sleep(5)
+            bathStart = ptime.time()
 
-            self.patchCell()
+            self.patchCell(bathStart)
 
             finalState = self.dev.getState()
             if finalState.stateName != "whole cell":
@@ -69,33 +184,45 @@ class TaskRunnerPatchProtocol(PatchProtocol):
         except:
             pa.setError(sys.exc_info())
         finally:
+            # disconnect so the state manager / scope do not keep this protocol
+            # instance alive (and receiving signals) after the attempt completes
+            pg.disconnect(self.dev.stateManager().sigStateChanged, self.devStateChanged)
+            if self._scopeChanged is not None:
+                pg.disconnect(self.scope.sigLightChanged, self._scopeLightChanged)
+            if self._cameraStarted is not None:
+                pg.disconnect(self.camera.sigCameraStarted, self._cameraStartedEvent)
+            # drop any buffered state references so they can be collected
+            self.clearStateQueue()
+            # make sure queued image writes have hit the disk before cleanup; a
+            # failed write is recorded but must not skip the pipette handling below
+            while self._pendingSaves:
+                try:
+                    self._pendingSaves.pop(0).result()
+                except Exception:
+                    if pa.error is None:
+                        pa.setError(sys.exc_info())
             if self.dev.broken:
                 self.swapPipette()
             elif not self.dev.clean:
                 self.cleanPipette()
 
-    def patchCell(self):
+    def patchCell(self, bathStart=None):
         pa = self.patchAttempt
 
         # Set target cell position, taking error correction into account
         targetPos = pa.pipetteTargetPosition()
-        if not np.all(np.isfinite(targetPos)):
+        if not all(math.isfinite(x) for x in targetPos):
             raise Exception("No valid target position for this attempt (probably automatic recalibration failed)")
 
         pa.setStatus("moving to target")
-        self.dev.pipetteDevice.setTarget(targetPos)
+        self._approachTarget(targetPos)
 
-        # move to 100 um above cell, fast
-        pos = np.array(targetPos) + np.array([100e-6, 100e-6, 100e-6])
-        fut = self.dev.pipetteDevice._moveToGlobal(pos, speed="fast")
-        self.wait([fut])
-
-        # move to 10 um above cell, slow
-        pos = np.array(targetPos) + np.array([0, 0, 10e-6])
-        # don't use target move here; we don't need all the obstacle avoidance.
-        # fut = self.dev.pipetteDevice.goTarget(speed='fast')
-        fut = self.dev.pipetteDevice._moveToGlobal(pos, speed="slow")
-        self.wait([fut])
+        if bathStart is not None:
+            # give the bath state its full 5 s settle time before starting cell
+            # detection; usually the approach moves have already covered this
+            remaining = 5.0 - (ptime.time() - bathStart)
+            if remaining > 0:
+                time.sleep(remaining)
 
         self.clearStateQueue()
 
@@ -103,10 +230,10 @@ class TaskRunnerPatchProtocol(PatchProtocol):
         pa.setStatus("cell patching")
         self.dev.setState("cell detect")
         while True:
+            # block until the pipette changes state; stopRequested() wakes us up with a sentinel
+            state = self._getNextState()
             self.checkStop()
-            try:
-                state = self.stateQueue.get(timeout=0.2)
-            except queue.Empty:
+            if state is _STOP_SENTINEL:
                 continue
 
             if state.stateName in ("whole cell", "fouled", "broken"):
@@ -114,52 +241,69 @@ class TaskRunnerPatchProtocol(PatchProtocol):
             else:
                 pa.setStatus(f"cell patching: {state.stateName}")
 
-            while True:
-                try:
-                    # raise exception if this state fails
-                    state.wait(timeout=0.2)
-                    break
-                except state.Timeout:
-                    self.checkStop()
+            # raise exception if this state fails; stopRequested() stops the state,
+            # causing this wait to return early. Publish the state before re-checking
+            # for a stop: a stop arriving before the assignment is caught by the
+            # re-check, one arriving after is caught by state.stop().
+            self._currentState = state
+            try:
+                self.checkStop()
+                state.wait(timeout=None)
+            finally:
+                self._currentState = None
+            self.checkStop()
+
+    def _approachTarget(self, targetPos):
+        """Move the pipette into position above the target cell.
+
+        Subclasses may reimplement this to customize the approach.
+        """
+        pipette = self.dev.pipetteDevice
+        targetPos = np.asarray(targetPos)
+        pipette.setTarget(targetPos)
+
+        # move to 100 um above cell, fast
+        pos = targetPos + _FAST_APPROACH_OFFSET
+        fut = pipette._moveToGlobal(pos, speed="fast")
+        self.wait([fut])
+
+        # move to 10 um above cell, slow
+        pos = targetPos + _SLOW_APPROACH_OFFSET
+        # don't use target move here; we don't need all the obstacle avoidance.
+        # fut = pipette.goTarget(speed='fast')
+        fut = pipette._moveToGlobal(pos, speed="slow")
+        self.wait([fut])
 
     def abortPatchProtocol(self):
         pass
 
     def clearStateQueue(self):
-        # clear out information about any pipette states before now
-        while not self.stateQueue.empty():
-            self.stateQueue.get(timeout=0)
+        # clear out information about any pipette states before now; the flush runs
+        # under the same condition lock as devStateChanged, so no state arriving
+        # mid-drain can be lost or retained unpredictably
+        with self._stateQueueCond:
+            self.stateQueue.clear()
 
     def runProtocol(self, pa):
         """Cell is patched; lock the stage and begin protocol.
         """
-        # focus camera on cell
+        # focus camera on cell; the filter turret / illumination switch runs while
+        # the stage is still moving, since the two involve independent hardware
         pa.setStatus("focus on cell")
-        self.camera.moveCenterToGlobal(pa.globalTargetPosition(), speed="fast", center="roi").wait()
+        focusFut = self.camera.moveCenterToGlobal(pa.globalTargetPosition(), speed="fast", center="roi")
 
-        man = getManager()
-        turret = man.getDevice("FilterTurret")
-        illum = man.getDevice("Illumination")
+        self._switchToBrightfield()
 
-        # set filter wheel / illumination
-        turret.setPosition(1).wait()
-        time.sleep(2)  # scope automatically changes RL/TL settings, sometimes in a bad way. sleep and set manually:
-        illum.SetTLIllumination(1)
-        illum.SetRLIllumination(1)
+        self.wait([focusFut], timeout=None)
 
         # take a picture
         pa.setStatus("say cheese!")
         frame = self.camera.acquireFrames(n=1, stack=False)
-        frame.saveImage(self.dh, "patch_image.tif")
+        self._saveImage(frame, "patch_image.tif")
 
         pa.setStatus("running whole cell protocol")
 
-        # switch to RL
-        turret.setPosition(0).wait()
-        time.sleep(2)  # scope automatically changes RL/TL settings, sometimes in a bad way. sleep and set manually:
-        illum.SetTLIllumination(2)
-        illum.SetRLIllumination(2)
-        time.sleep(1)
+        self._switchToFluorescence()
 
         try:
             # take another picture
@@ -167,24 +311,15 @@ class TaskRunnerPatchProtocol(PatchProtocol):
             self.camera.setParams({"exposure": 0.05, "binning": (4, 4)})
 
             frame = self.camera.acquireFrames(n=1, stack=False)
-            frame.saveImage(self.dh, "fluor_image.tif")
-
-            man = getManager()
-            # TODO: select correct task runner for this pipette
-            taskrunner = None
-            for mod in man.listModules():
-                if not mod.startswith("Task Runner"):
-                    continue
-                mod = man.getModule(mod)
-                if self.dev.clampDevice.name() in mod.docks:
-                    taskrunner = mod
-                    break
+            self._saveImage(frame, "fluor_image.tif")
 
-            assert taskrunner is not None, f"No task runner found that uses {self.dev.clampDevice.name()}"
+            clampName = self.dev.clampDevice.name()
+            taskrunner = self.module.getTaskRunner(clampName)
+            assert taskrunner is not None, f"No task runner found that uses {clampName}"
 
             # 300 Hz
             # self.camera.setParams({'regionH': 700, 'regionY': 680, 'regionX': 8, 'regionW': 2028, 'exposure': 0.0030013})
-            # 1kHz
+            # 1kHz  (binning is already 4x4 from the fluorescence snap above)
             self.camera.setParams(
                 {
                     "regionH": 164,
@@ -192,12 +327,14 @@ class TaskRunnerPatchProtocol(PatchProtocol):
                     "regionX": 8,
                     "regionW": 2032,
                     "exposure": 0.0010134,
-                    "binning": (4, 4),
                 }
             )
 
             # prepare camera to be triggered by the DAQ for this pipette
             self.configureCamera()
+            # runInGuiThread blocks only while the GUI thread starts the sequence;
+            # runSequence returns a future immediately and self.wait() below watches it
+            # with responsive stop checks, so the patch thread is never pinned here
             fut = runInGuiThread(taskrunner.runSequence, store=True, storeDirHandle=self.dh)
             try:
                 self.wait([fut], timeout=300)
@@ -206,20 +343,69 @@ class TaskRunnerPatchProtocol(PatchProtocol):
                 raise
 
         finally:
-            # switch off RL
-            turret.setPosition(1).wait()
-            time.sleep(2)  # scope automatically changes RL/TL settings, sometimes in a bad way. sleep and set manually:
-            illum.SetTLIllumination(1)
-            illum.SetRLIllumination(1)
+            self._restoreIllumination()
 
-            self.camera.setParams(cameraParams)  # , autoRestart=True, autoCorrect=True)
+            # restore only the parameters modified above; passing back the whole
+            # dict makes the driver re-commit values that never changed
+            changedKeys = ("regionX", "regionY", "regionW", "regionH", "exposure", "binning")
+            restoreParams = {k: cameraParams[k] for k in changedKeys if k in cameraParams}
+            self.camera.setParams(restoreParams)  # , autoRestart=True, autoCorrect=True)
 
             pa.setStatus("restart acquire video of camera")
+            if self._cameraStarted is not None:
+                self._cameraStarted.clear()
             self.camera.start()
 
-        time.sleep(2)
+        # wait for the camera to report that acquisition actually restarted
+        if self._cameraStarted is None:
+            time.sleep(2)
+        else:
+            self._cameraStarted.wait(2.0)
         pa.setStatus("whole cell protocol complete")
 
+    def _switchToBrightfield(self):
+        """Set filter wheel / illumination for a brightfield image of the patched cell.
+
+        Subclasses may reimplement this as a no-op if the hardware is not present.
+        """
+        _, illum = self._getTurretAndIllum()
+
+        self._setTurret(1)
+        illum.SetTLIllumination(1)
+        illum.SetRLIllumination(1)
+
+    def _switchToFluorescence(self):
+        """Set filter wheel / illumination for fluorescence imaging (switch to RL).
+        """
+        _, illum = self._getTurretAndIllum()
+
+        self._setTurret(0)
+        if self._scopeChanged is not None:
+            self._scopeChanged.clear()
+        illum.SetTLIllumination(2)
+        illum.SetRLIllumination(2)
+        # wait for the illumination change to be reported before imaging
+        self._waitForScopeChange(1.0)
+
+    def _restoreIllumination(self):
+        """Switch off RL and restore brightfield illumination after the protocol.
+        """
+        _, illum = self._getTurretAndIllum()
+
+        self._setTurret(1)
+        illum.SetTLIllumination(1)
+        illum.SetRLIllumination(1)
+
+    def _saveImage(self, frame, name):
+        """Queue *frame* to be written into the patch attempt directory without
+        blocking the protocol; runPatchProtocol joins the writes before cleanup.
+        """
+        # bound the number of outstanding writes so a slow disk applies backpressure
+        # instead of letting full-sensor frames pile up in memory
+        while len(self._pendingSaves) >= 2:
+            self._pendingSaves.pop(0).result()
+        self._pendingSaves.append(_imageWriterPool.submit(frame.saveImage, self.dh, name))
+
     def configureCamera(self):
         """Set camera exposure/trigger channels for this pipette's DAQ.
         """
@@ -227,8 +413,14 @@ class TaskRunnerPatchProtocol(PatchProtocol):
         # channels to use, but that's not supported yet so this is a temporary workaround.
         if "cameraChannels" in self.module.config:
             exp, trig = self.module.config["cameraChannels"][self.dev.name()]
+            if self.module.lastCameraChannels == (exp, trig):
+                # camera is already wired to this pipette's DAQ; only another protocol
+                # reconfiguring the shared camera can invalidate this, and it would
+                # update lastCameraChannels in doing so
+                return
             self.camera.reconfigureChannel("exposure", {"channel": exp})
             self.camera.reconfigureChannel("trigger", {"channel": trig})
+            self.module.lastCameraChannels = (exp, trig)
 
     def cleanPipette(self):
         pa = self.patchAttempt